@@ -10,6 +10,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class BasicBlock(nn.Module):
@@ -123,6 +124,22 @@ class WideResNet(nn.Module):
                 if use_fixup:
                     m.weight.data.zero_()
 
+    def fuse_bn(self):
+        """Folds every BatchNorm that directly follows a convolution into it (eval mode only)"""
+        for m in list(self.modules()):
+            if isinstance(m, BasicBlock) and m.use_bn:
+                m.conv1 = fuse_conv_bn_eval(m.conv1, m.bn2)
+                m.bn2 = nn.Identity()
+
+        # The stem output only reaches the first block through its bn1 when the block has
+        # a projection shortcut, otherwise it is also added to the residual unnormalized
+        first = self.block1.layer[0]
+        if first.use_bn and not first.equalInOut:
+            self.conv1 = fuse_conv_bn_eval(self.conv1, first.bn1)
+            first.bn1 = nn.Identity()
+
+        return self
+
     def forward(self, x):
         out = self.conv1(x)
         out = self.block1(out)
@@ -4,24 +4,28 @@ Wide ResNet by Sergey Zagoruyko and Nikos Komodakis
 """
 
 import argparse
+import copy
 import os
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 import torch.optim
 import torch.utils.data
-import torchvision.transforms as transforms
+import torchvision.transforms.v2 as transforms
 import torchvision.datasets as datasets
-from torch.autograd import Variable
+from torch.nn.modules.utils import consume_prefix_in_state_dict_if_present
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.tensorboard import SummaryWriter
 
 from model import WideResNet
-from utils.cutout import Cutout
-from tensorboard_logger import configure, log_value
+from utils.augment import GPUAugment
+from utils.loader import CUDAPrefetcher, TensorLoader
 
 
 parser = argparse.ArgumentParser(description="PyTorch WideResNet Training")
@@ -29,6 +33,10 @@ parser.add_argument("--dataset", default="cifar10", type=str,
                     help="dataset (cifar10 [default] or cifar100)")
 parser.add_argument("--epochs", default=200, type=int,
                     help="number of total epochs to run")
+# torchrun starts one process per GPU, the CPUs are shared between the processes of a node
+parser.add_argument("-j", "--workers", type=int,
+                    default=max(1, (os.cpu_count() or 4) // int(os.environ.get("LOCAL_WORLD_SIZE", 1)) - 1),
+                    help="number of data loading workers per process (default: CPUs per process - 1)")
 parser.add_argument("--start-epoch", default=0, type=int,
                     help="manual epoch number (useful on restarts)")
 parser.add_argument("-b", "--batch-size", default=128, type=int,
@@ -59,15 +67,22 @@ parser.add_argument("--length", default=16, type=int,
                     help="length of the holes")
 parser.add_argument("--no-augment", dest="augment", action="store_false",
                     help="whether to use standard augmentation (default: True)")
+parser.add_argument("--no-amp", dest="amp", action="store_false",
+                    help="whether to use bf16/fp16 mixed precision (default: True)")
+parser.add_argument("--compile",
+                    help="compile the model with torch.compile", action="store_true")
 parser.add_argument("--resume", default="", type=str,
                     help="path to latest checkpoint (default: none)")
 parser.add_argument("--name", default="WideResNet-28-10", type=str,
                     help="name of experiment")
 parser.add_argument("--tensorboard",
                     help="Log progress to TensorBoard", action="store_true")
-parser.set_defaults(augment=True)
+parser.set_defaults(augment=True, amp=True)
 
 best_prec1 = 0
+writer = None
+# Checkpoints are written one at a time in the background, off the training loop
+_ckpt_pool = ThreadPoolExecutor(max_workers=1)
 
 
 class AverageMeter(object):
@@ -88,124 +103,235 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class GPUAverageMeter(object):
+    """Computes and stores the average and current value of a tensor on its device.
+    Values are only copied to the host when val or avg is read.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._val = 0
+        self.sum = None
+        self.count = 0
+
+    def update(self, val, n=1):
+        self._val = val.detach()
+        if self.sum is None:
+            self.sum = torch.zeros_like(self._val, dtype=torch.float32)
+        # A single in-place kernel, the count is known on the host and stays there
+        self.sum.add_(self._val, alpha=n)
+        self.count += n
+
+    def all_reduce(self):
+        """Sums the running totals over all processes of the default process group"""
+        total = torch.cat([self.sum.view(1), self.sum.new_tensor([self.count])])
+        dist.all_reduce(total)
+        self.sum, self.count = total[0], int(total[1])
+
+    @property
+    def val(self):
+        return float(self._val)
+
+    @property
+    def avg(self):
+        return self.count and float(self.sum / self.count) or 0.
+
+
 def main():
-    global args, best_prec1
+    global args, best_prec1, writer
     args = parser.parse_args()
 
+    # One process per GPU when launched with torchrun, otherwise a single process on one GPU
+    args.world_size = int(os.environ.get("WORLD_SIZE", 1))
+    args.rank = int(os.environ.get("RANK", 0))
+    args.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    args.distributed = args.world_size > 1
+    torch.cuda.set_device(args.local_rank)
+
+    if args.distributed:
+        dist.init_process_group("nccl")
+
+    # Only the first process prints, logs and saves checkpoints
+    args.tensorboard = args.tensorboard and args.rank == 0
+
     if args.tensorboard:
-        configure(f"runs/{args.name}")
+        # Events are buffered and written by the writer's background thread
+        writer = SummaryWriter(f"runs/{args.name}", flush_secs=60)
 
-    normalize = transforms.Normalize(mean=[x / 255.0 for x in [125.3, 123.0, 113.9]],
-                                     std=[x / 255.0 for x in [63.0, 62.1, 66.7]])
+    mean = [x / 255.0 for x in [125.3, 123.0, 113.9]]
+    std = [x / 255.0 for x in [63.0, 62.1, 66.7]]
+    normalize = transforms.Normalize(mean=mean, std=std)
     
-    if args.augment:
-        transform_train = transforms.Compose([
-        	transforms.ToTensor(),
-        	transforms.Lambda(lambda x: F.pad(x.unsqueeze(0), (4,4,4,4), mode="reflect").squeeze()),
-            transforms.ToPILImage(),
-            transforms.RandomCrop(32),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-            ])
-    else:
-        transform_train = transforms.Compose([
-            transforms.ToTensor(),
-            normalize,
-            ])
-
-    if args.cutout:
-        transform_train.transforms.append(Cutout(n_holes=args.n_holes, length=args.length))
+    to_tensor = transforms.Compose([
+        transforms.ToImage(),
+        transforms.ToDtype(torch.float32, scale=True),
+        ])
+
+    # Training images are kept on the GPU as uint8 and augmented there batch-wise
+    augment = GPUAugment(mean, std, padding=args.augment and 4 or 0, flip=args.augment,
+                         n_holes=args.cutout and args.n_holes or 0, length=args.length)
 
     transform_test = transforms.Compose([
-        transforms.ToTensor(),
+        to_tensor,
         normalize
         ])
 
-    kwargs = {"num_workers": 1, "pin_memory": True}
+    kwargs = {"num_workers": args.workers, "pin_memory": True}
+    if args.workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=4)
     assert(args.dataset == "cifar10" or args.dataset == "cifar100")
 
-    train_loader = torch.utils.data.DataLoader(
-        datasets.__dict__[args.dataset.upper()]("../data", train=True, download=True,
-        transform=transform_train), batch_size=args.batch_size, shuffle=True, **kwargs)
-    val_loader = torch.utils.data.DataLoader(
-        datasets.__dict__[args.dataset.upper()]("../data", train=False, transform=transform_test),
-        batch_size=args.batch_size, shuffle=True, **kwargs)
+    if args.distributed and args.rank != 0:
+        dist.barrier()  # let the first process download the dataset
+    train_set = datasets.__dict__[args.dataset.upper()]("../data", train=True, download=True)
+    if args.distributed and args.rank == 0:
+        dist.barrier()
+
+    # The raw images are NHWC, viewed as NCHW they are already in channels_last layout
+    train_set = torch.utils.data.TensorDataset(
+        torch.from_numpy(train_set.data).cuda().permute(0, 3, 1, 2),
+        torch.tensor(train_set.targets).cuda())
+    # --batch-size is the global batch size, it is split evenly between the processes
+    assert args.batch_size % args.world_size == 0, "Batch size must be divisible by the number of GPUs"
+    train_sampler = torch.utils.data.DistributedSampler(train_set) if args.distributed else None
+    # With --compile the last incomplete batch is dropped to keep the input shape fixed
+    train_loader = TensorLoader(train_set, batch_size=args.batch_size // args.world_size,
+                                shuffle=True, sampler=train_sampler, drop_last=args.compile)
+    # Each process validates its own shard of the test set, the results are summed up
+    val_set = datasets.__dict__[args.dataset.upper()]("../data", train=False, transform=transform_test)
+    val_sampler = torch.utils.data.DistributedSampler(val_set, shuffle=False) if args.distributed else None
+    # Without gradients to keep, validation fits much larger batches
+    val_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
+        val_set, batch_size=args.batch_size * 4, shuffle=False, sampler=val_sampler, **kwargs))
 
     model = WideResNet(args.layers, args.dataset == "cifar10" and 10 or 100, 
                        args.widen_factor, droprate=args.droprate,
                        use_bn=args.batchnorm, use_fixup=args.fixup)
 
     param_num = sum([p.data.nelement() for p in model.parameters()])
-    print(f"Number of model parameters: {param_num}")
+    if args.rank == 0:
+        print(f"Number of model parameters: {param_num}")
 
-    if torch.cuda.device_count() > 1:
-        model = torch.nn.DataParallel(model)
-    model = model.cuda()
+    # channels_last lets cuDNN pick NHWC tensor-core kernels for the convolutions
+    model = model.cuda().to(memory_format=torch.channels_last)
+
+    cudnn.benchmark = True
+    criterion = nn.CrossEntropyLoss().cuda()
+    optimizer = torch.optim.SGD(model.parameters(), args.lr,
+                                momentum=args.momentum, nesterov=args.nesterov,
+                                weight_decay=args.weight_decay)
+    # Divides the LR by 5 at the 60th, 120th and 160th epochs (counting from 1)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[59, 119, 159], gamma=0.2)
+    # bf16 keeps the fp32 exponent range, so loss scaling is only needed for fp16.
+    # Pre-Ampere GPUs only emulate bf16, they train faster in fp16 with a GradScaler
+    args.amp_dtype = torch.cuda.get_device_capability()[0] >= 8 and torch.bfloat16 or torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=args.amp and args.amp_dtype == torch.float16)
 
     if args.resume:
         if os.path.isfile(args.resume):
-            print(f"=> loading checkpoint {args.resume}")
-            checkpoint = torch.load(args.resume)
+            if args.rank == 0:
+                print(f"=> loading checkpoint {args.resume}")
+            checkpoint = torch.load(args.resume, map_location=f"cuda:{args.local_rank}")
             args.start_epoch = checkpoint["epoch"]
             best_prec1 = checkpoint["best_prec1"]
+            # Checkpoints of multi-GPU runs with DataParallel have "module." prefixed keys
+            consume_prefix_in_state_dict_if_present(checkpoint["state_dict"], "module.")
             model.load_state_dict(checkpoint["state_dict"])
-            print(f"=> loaded checkpoint '{args.resume}' (epoch {checkpoint['epoch']})")
-        else:
+            if "scheduler" in checkpoint:
+                scheduler.load_state_dict(checkpoint["scheduler"])
+            else:
+                for _ in range(args.start_epoch):
+                    scheduler.step()
+            # A disabled scaler (bf16 or --no-amp) saves an empty state
+            if checkpoint.get("scaler"):
+                scaler.load_state_dict(checkpoint["scaler"])
+            if args.rank == 0:
+                print(f"=> loaded checkpoint '{args.resume}' (epoch {checkpoint['epoch']})")
+        elif args.rank == 0:
             print(f"=> no checkpoint found at {args.resume}")
 
-    cudnn.benchmark = True
-    criterion = nn.CrossEntropyLoss().cuda()
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum, nesterov=args.nesterov,
-                                weight_decay=args.weight_decay)
+    # The bare model is kept for checkpointing, its state_dict keys stay unchanged
+    training_model = model
+    if args.distributed:
+        training_model = DistributedDataParallel(model, device_ids=[args.local_rank])
+    if args.compile:
+        training_model = torch.compile(training_model, mode="max-autotune", dynamic=False)
+
+    if train_sampler is not None:
+        train_sampler.set_epoch(args.start_epoch)
 
+    saving = None
     for epoch in range(args.start_epoch, args.epochs):
-        adjust_learning_rate(optimizer, epoch+1)
-        train(train_loader, model, criterion, optimizer, epoch)
+        if args.tensorboard:
+            writer.add_scalar("learning_rate", scheduler.get_last_lr()[0], epoch + 1)
+
+        train(train_loader, augment, training_model, criterion, optimizer, scaler, epoch)
+        scheduler.step()
+        # Prepare the next epoch while validation and checkpointing keep the main thread busy
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch + 1)
+        train_loader.warmup()
         
-        prec1 = validate(val_loader, model, criterion, epoch)
+        # Validate an inference copy with BatchNorm folded into the preceding convolutions
+        fused_model = copy.deepcopy(model).eval().fuse_bn()
+        prec1 = validate(val_loader, fused_model, criterion, epoch)
+        del fused_model
         is_best = prec1 > best_prec1
         best_prec1 = max(prec1, best_prec1)
-        save_checkpoint({
-            "epoch": epoch + 1,
-            "state_dict": model.state_dict(),
-            "best_prec1": best_prec1,
-        }, is_best)
+        if saving is not None:
+            saving.result()  # re-raises errors of the previous write
+        if args.rank == 0:
+            saving = save_checkpoint({
+                "epoch": epoch + 1,
+                "state_dict": model.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "scaler": scaler.state_dict(),
+                "best_prec1": best_prec1,
+            }, is_best)
+
+    if saving is not None:
+        saving.result()
+    _ckpt_pool.shutdown()
+
+    if writer is not None:
+        writer.close()
+
+    if args.distributed:
+        dist.destroy_process_group()
 
-    print("Best accuracy: ", best_prec1)
+    if args.rank == 0:
+        print("Best accuracy: ", best_prec1)
 
 
-def train(train_loader, model, criterion, optimizer, epoch):
+def train(train_loader, augment, model, criterion, optimizer, scaler, epoch):
     """Train for one epoch on the training set"""
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
+    losses = GPUAverageMeter()
+    top1 = GPUAverageMeter()
 
     model.train()
 
     end = time.time()
     for i, (input, target) in enumerate(train_loader):
-        target = target.cuda(async=True)
-        input = input.cuda()
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
+        input = augment(input)
+        with torch.autocast("cuda", dtype=args.amp_dtype, enabled=args.amp):
+            output = model(input)
+            loss = criterion(output, target)
 
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        prec1 = accuracy(output.detach(), target, topk=(1,))[0]
+        losses.update(loss, input.size(0))
+        top1.update(prec1, input.size(0))
 
-        prec1 = accuracy(output.data, target, topk=(1,))[0]
-        losses.update(loss.data.item(), input.size(0))
-        top1.update(prec1.item(), input.size(0))
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if i % args.print_freq == 0:
+        if args.rank == 0 and i % args.print_freq == 0:
             print("Epoch: [{0}][{1}/{2}]\t"
                   "Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
                   "Loss {loss.val:.4f} ({loss.avg:.4f})\t"
@@ -213,37 +339,37 @@ def train(train_loader, model, criterion, optimizer, epoch):
                       epoch, i, len(train_loader), batch_time=batch_time,
                       loss=losses, top1=top1))
     
+    if args.distributed:
+        losses.all_reduce()
+        top1.all_reduce()
+
     if args.tensorboard:
-        log_value("train_loss", losses.avg, epoch)
-        log_value("train_acc", top1.avg, epoch)
+        writer.add_scalar("train_loss", losses.avg, epoch)
+        writer.add_scalar("train_acc", top1.avg, epoch)
 
 def validate(val_loader, model, criterion, epoch):
     """Perform validation on the validation set"""
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
+    losses = GPUAverageMeter()
+    top1 = GPUAverageMeter()
 
     model.eval()
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
-        input = input.cuda()
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
-
-        with torch.no_grad():
-            output = model(input_var)
-        loss = criterion(output, target_var)
+        input = input.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode(), torch.autocast("cuda", dtype=args.amp_dtype, enabled=args.amp):
+            output = model(input)
+            loss = criterion(output, target)
 
-        prec1 = accuracy(output.data, target, topk=(1,))[0]
-        losses.update(loss.data.item(), input.size(0))
-        top1.update(prec1.item(), input.size(0))
+        prec1 = accuracy(output.detach(), target, topk=(1,))[0]
+        losses.update(loss, input.size(0))
+        top1.update(prec1, input.size(0))
 
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if i % args.print_freq == 0:
+        if args.rank == 0 and i % args.print_freq == 0:
             print("Test: [{0}/{1}]\t"
                   "Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
                   "Loss {loss.val:.4f} ({loss.avg:.4f})\t"
@@ -251,38 +377,41 @@ def validate(val_loader, model, criterion, epoch):
                       i, len(val_loader), batch_time=batch_time, loss=losses,
                       top1=top1))
 
-    print(" * Prec@1 {top1.avg:.3f}".format(top1=top1))
+    if args.distributed:
+        losses.all_reduce()
+        top1.all_reduce()
+
+    if args.rank == 0:
+        print(" * Prec@1 {top1.avg:.3f}".format(top1=top1))
 
     if args.tensorboard:
-        log_value("val_loss", losses.avg, epoch)
-        log_value("val_acc", top1.avg, epoch)
+        writer.add_scalar("val_loss", losses.avg, epoch)
+        writer.add_scalar("val_acc", top1.avg, epoch)
 
     return top1.avg
 
 
 def save_checkpoint(state, is_best, filename="checkpoint.pth.tar"):
-    """Saves checkpoint to disk"""
+    """Saves checkpoint to disk in a background thread"""
     directory = "runs/%s/"%(args.name)
 
     if not os.path.exists(directory):
         os.makedirs(directory)
 
     filename = directory + filename
-    torch.save(state, filename)
+    best_filename = is_best and directory + "model_best.pth.tar" or None
 
-    if is_best:
-        shutil.copyfile(filename, "runs/%s/"%(args.name) + "model_best.pth.tar")
+    # Snapshot the weights on the host so training can keep updating the GPU copies
+    state = dict(state, state_dict={k: v.cpu() for k, v in state["state_dict"].items()})
 
+    return _ckpt_pool.submit(_write_checkpoint, state, filename, best_filename)
 
-def adjust_learning_rate(optimizer, epoch):
-    """Sets the learning rate to the initial LR divided by 5 at 60th, 120th and 160th epochs"""
-    lr = args.lr * ((0.2 ** int(epoch >= 60)) * (0.2 ** int(epoch >= 120))* (0.2 ** int(epoch >= 160)))
-    
-    if args.tensorboard:
-        log_value("learning_rate", lr, epoch)
 
-    for param_group in optimizer.param_groups:
-        param_group["lr"] = lr
+def _write_checkpoint(state, filename, best_filename=None):
+    torch.save(state, filename)
+
+    if best_filename is not None:
+        shutil.copyfile(filename, best_filename)
 
 
 def accuracy(output, target, topk=(1,)):
@@ -290,13 +419,18 @@ def accuracy(output, target, topk=(1,)):
     maxk = max(topk)
     batch_size = target.size(0)
 
+    if maxk == 1:
+        # argmax is a single reduction, topk(1) launches a more expensive selection kernel
+        prec = output.argmax(dim=1).eq(target).float().sum().mul_(100.0 / batch_size)
+        return [prec] + [prec.clone() for _ in topk[1:]]
+
     _, pred = output.topk(maxk, 1, True, True)
     pred = pred.t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
+    correct = pred.eq(target.view(1, -1).expand_as(pred)).float()
 
     res = []
     for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0)
+        correct_k = correct[:k].sum()
         res.append(correct_k.mul_(100.0 / batch_size))
 
     return res
@@ -0,0 +1,81 @@
+"""
+Batch-wise CIFAR augmentation on the GPU: reflect-padded random crop, horizontal flip,
+normalization and cutout applied to a whole uint8 batch after the host to device copy.
+Cutout follows the implementation by Machine Learning Research Group at the University of Guelph:
+https://github.com/uoguelph-mlrg/Cutout
+"""
+
+import torch
+
+
+class GPUAugment(object):
+    """Normalize and augment a batch of uint8 images on their device.
+    Args:
+        mean (sequence): Per-channel means of the images scaled to [0, 1].
+        std (sequence): Per-channel standard deviations of the images scaled to [0, 1].
+        padding (int): Reflect padding of the random crop, 0 disables cropping.
+        flip (bool): Whether to randomly flip images horizontally.
+        n_holes (int): Number of cutout patches per image, 0 disables cutout.
+        length (int): The length (in pixels) of each square cutout patch.
+    """
+    def __init__(self, mean, std, padding=0, flip=False, n_holes=0, length=16):
+        self.scale = torch.tensor([1. / (255. * s) for s in std]).view(1, -1, 1, 1)
+        self.shift = torch.tensor([-m / s for m, s in zip(mean, std)]).view(1, -1, 1, 1)
+        self.padding = padding
+        self.flip = flip
+        self.n_holes = n_holes
+        self.length = length
+
+    def __call__(self, img):
+        """
+        Args:
+            img (Tensor): uint8 image batch of size (N, C, H, W).
+        Returns:
+            Tensor: Normalized float image batch of the same size. Random crops and flips
+                produce it in channels_last memory format, otherwise it keeps the input layout.
+        """
+        n, c, h, w = img.shape
+        device = img.device
+
+        if self.scale.device != device:
+            self.scale = self.scale.to(device)
+            self.shift = self.shift.to(device)
+
+        if self.padding > 0 or self.flip:
+            # Crop offsets, flips and reflect padding are folded into one gather on uint8 data
+            rows = torch.arange(h, device=device).expand(n, h)
+            cols = torch.arange(w, device=device).expand(n, w)
+
+            if self.padding > 0:
+                rows = rows + torch.randint(-self.padding, self.padding + 1, (n, 1), device=device)
+                cols = cols + torch.randint(-self.padding, self.padding + 1, (n, 1), device=device)
+                rows = (h - 1) - ((h - 1) - rows.abs()).abs()
+                cols = (w - 1) - ((w - 1) - cols.abs()).abs()
+
+            if self.flip:
+                flip = torch.rand(n, 1, device=device) < 0.5
+                cols = torch.where(flip, cols.flip(1), cols)
+
+            # Gathered as (N, H, W, C), so the result is an NCHW view in channels_last layout
+            img = img[torch.arange(n, device=device).view(n, 1, 1, 1),
+                      torch.arange(c, device=device).view(1, 1, 1, c),
+                      rows.view(n, h, 1, 1),
+                      cols.view(n, 1, w, 1)].permute(0, 3, 1, 2)
+
+        out = torch.addcmul(self.shift, img.float(), self.scale)
+
+        if self.n_holes > 0:
+            hole = torch.zeros(n, h, w, dtype=torch.bool, device=device)
+            ys = torch.arange(h, device=device).view(1, h)
+            xs = torch.arange(w, device=device).view(1, w)
+
+            for _ in range(self.n_holes):
+                y = torch.randint(h, (n, 1), device=device)
+                x = torch.randint(w, (n, 1), device=device)
+                in_y = (ys >= y - self.length // 2) & (ys < y + self.length // 2)
+                in_x = (xs >= x - self.length // 2) & (xs < x + self.length // 2)
+                hole |= in_y.unsqueeze(2) & in_x.unsqueeze(1)
+
+            out.masked_fill_(hole.unsqueeze(1), 0.)
+
+        return out
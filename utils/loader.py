@@ -0,0 +1,95 @@
+"""
+Mini-batch iteration over a dataset that is already held in (GPU) memory as tensors.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.utils.data
+
+
+class TensorLoader(object):
+    """Yields mini-batches of a TensorDataset by indexing its tensors on their device.
+    Unlike DataLoader there are no worker processes, collation or host to device copies.
+    Args:
+        dataset (TensorDataset): Dataset whose tensors hold all the samples.
+        batch_size (int): How many samples per batch to load.
+        shuffle (bool): Whether to reshuffle the samples every epoch.
+        sampler (Sampler, optional): Strategy to draw sample indices, overrides shuffle.
+        drop_last (bool): Whether to drop the last incomplete batch.
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, drop_last=False):
+        if sampler is None and shuffle:
+            sampler = torch.utils.data.RandomSampler(dataset)
+        elif sampler is None:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.drop_last = drop_last
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._warmup = None
+
+    def _sample(self):
+        return torch.tensor(list(self.sampler), device=self.dataset.tensors[0].device)
+
+    def warmup(self):
+        """Draws the sample order of the next epoch in a background thread"""
+        self._warmup = self._pool.submit(self._sample)
+
+    def __iter__(self):
+        if self._warmup is not None:
+            warmup, self._warmup = self._warmup, None
+            indices = warmup.result()  # re-raises errors of the background draw
+        else:
+            indices = self._sample()
+
+        if self.drop_last:
+            indices = indices[:len(self) * self.batch_size]
+
+        for batch in indices.split(self.batch_size):
+            yield tuple(t[batch] for t in self.dataset.tensors)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class CUDAPrefetcher(object):
+    """Wraps a loader of host batches and copies the next batch to the GPU on a side stream
+    while the current one is being processed.
+    Args:
+        loader (DataLoader): Loader yielding tuples of (pinned) CPU tensors.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def _preload(self, it):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return tuple(t.cuda(non_blocking=True) for t in batch)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self._preload(it)
+
+        while batch is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(stream)
+
+            next_batch = self._preload(it)
+            yield batch
+            batch = next_batch
+
+    def __len__(self):
+        return len(self.loader)